@@ -1,10 +1,24 @@
+import asyncio
+import concurrent.futures
+import cProfile
 import discord
+import gzip
+import hashlib
+import html
+import io
 import json
 import logging
 import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
 
 import discord.ext.commands.errors as errors
 
+from collections import OrderedDict
+from datetime import datetime
 from difflib import SequenceMatcher
 from discord.ext import commands
 from discord.ext.commands.context import Context
@@ -29,14 +43,38 @@ UNDEF_STATE_EMOJI = "\U000026AA"
 ERROR_COLOR = int(get_config("error_color"), 16)
 BOT_COLOR = int(get_config("bot_color"), 16)
 
+START_TIME = time.perf_counter()
+# Parsed data takes about 3 to 5 times the size of its save-file, used to estimate it before loading
+WARMUP_SIZE_FACTOR = 5
+
 # Init Logging
 logging.basicConfig(filename=get_config("logfile"), level=logging.INFO)
 
-with open(get_config("token_file"), "r") as file:
-    token = file.read()
-
 client = commands.Bot(command_prefix=get_config("prefix"))
 
+# Background worker state, guilds are marked as changed by write_data
+SNAPSHOT_TIME_FORMAT = "%Y%m%dT%H%M%S%f"
+change_lock = threading.Lock()
+changed_guilds = dict()
+initial_states = dict()
+snapshot_seen = set()
+change_counters = dict()
+known_guilds = dict()
+exported_counters = dict()
+# Cached data per guild id, ordered from least to most recently used, and its measured size in bytes
+data_cache = OrderedDict()
+cache_sizes = dict()
+cache_size = 0
+warmup_started = False
+workers = dict()
+worker_stop = threading.Event()
+
+# Whether the profile command is currently capturing
+profiling = False
+
+# Secondary indexes per guild id: {"tag": {tag: names}, "status": {status: names}}
+indexes = dict()
+
 
 def get_fields() -> dict:
     """
@@ -49,16 +87,97 @@ def get_fields() -> dict:
     return data
 
 
-def get_data(ctx: Context, backup=False) -> dict:
+def get_save_path(guild, backup=False) -> str:
     """
-    Get all data corresponding to the context
-    :param ctx: Context of the request
+    Get the path of the save-file of a guild
+    :param guild: Guild the data belongs to
+    :param backup: Defines whether the path of the previous save should be returned
+    :return: Path of the save-file
+    """
+    if backup:
+        return f"{get_config('savepath')}{guild}{guild.id}.json"
+    return f"{get_config('savepath')}{guild}.json"
+
+
+def copy_data(data: dict) -> dict:
+    """
+    Helper function to copy the data of a guild, so changes to the copy do not affect the cache
+    :param data: All entries of a guild
+    :return: Copy of the data, entries only contain strings so copying two levels is sufficient
+    """
+    return {name: dict(entry) for name, entry in data.items()}
+
+
+def get_data_size(data: dict) -> int:
+    """
+    Helper function to measure the memory used by the data of a guild
+    :param data: All entries of a guild
+    :return: Size in bytes, the field names are not counted as they are shared between all entries
+    """
+    size = sys.getsizeof(data)
+    for name, entry in data.items():
+        size += sys.getsizeof(name) + sys.getsizeof(entry)
+        size += sum(sys.getsizeof(v) for v in entry.values())
+
+    return size
+
+
+def store_cache(guild_id: int, data: dict):
+    """
+    Store a copy of the data of a guild in the cache and evict the least recently used guilds while the cache
+    exceeds cache_memory_mb. Must be called while holding change_lock
+    :param guild_id: Id of the guild
+    :param data: All entries of the guild
+    """
+    global cache_size
+
+    data = copy_data(data)
+    size = get_data_size(data)
+    cache_size += size - cache_sizes.get(guild_id, 0)
+    cache_sizes[guild_id] = size
+    data_cache[guild_id] = data
+    data_cache.move_to_end(guild_id)
+
+    # The data written last is always kept, evicted guilds are read from their save-file again
+    limit = get_config("cache_memory_mb") * 1024 * 1024
+    while cache_size > limit and len(data_cache) > 1:
+        evicted, _ = data_cache.popitem(last=False)
+        cache_size -= cache_sizes.pop(evicted)
+
+
+def cache_data(guild, data: dict, version: int) -> bool:
+    """
+    Store the data of a guild in the cache, unless it has been written since it was read
+    :param guild: Guild the data belongs to
+    :param data: All entries of the guild
+    :param version: Change counter of the guild before the data was read
+    :return: Whether the data has been stored
+    """
+    with change_lock:
+        if guild.id in data_cache or change_counters.get(guild.id, 0) != version:
+            return False
+
+        store_cache(guild.id, data)
+        return True
+
+
+def load_guild_data(guild, backup=False) -> dict:
+    """
+    Get all data of a guild, the current data is served from the cache once it has been loaded
+    :param guild: Guild the data belongs to
     :param backup: Defines whether the previous save should be loaded
     :return: Stored data
     """
 
-    path = f"{get_config('savepath')}{ctx.guild}.json"
-    backup_path = f"{get_config('savepath')}{ctx.guild}{ctx.guild.id}.json"
+    if not backup:
+        with change_lock:
+            if guild.id in data_cache:
+                data_cache.move_to_end(guild.id)
+                return copy_data(data_cache[guild.id])
+            version = change_counters.get(guild.id, 0)
+
+    path = get_save_path(guild)
+    backup_path = get_save_path(guild, backup=True)
 
     if backup and os.path.isfile(path):
         path = backup_path
@@ -67,6 +186,9 @@ def get_data(ctx: Context, backup=False) -> dict:
         with open(path, "r") as data_file:
             data = json.load(data_file)
 
+        if not backup:
+            cache_data(guild, data, version)
+
         return data
 
     # Create the save-file of it does not exist
@@ -76,9 +198,22 @@ def get_data(ctx: Context, backup=False) -> dict:
     with open(backup_path, "w+") as save_file:
         json.dump(dict(), save_file)
 
+    if not backup:
+        cache_data(guild, {}, version)
+
     return {}
 
 
+def get_data(ctx: Context, backup=False) -> dict:
+    """
+    Get all data corresponding to the context
+    :param ctx: Context of the request
+    :param backup: Defines whether the previous save should be loaded
+    :return: Stored data
+    """
+    return load_guild_data(ctx.guild, backup)
+
+
 def write_data(data: dict, ctx: Context):
     """
     Write data to the save-file corresponding to the context
@@ -86,16 +221,463 @@ def write_data(data: dict, ctx: Context):
     :param ctx: context
     """
 
-    path = f"{get_config('savepath')}{ctx.guild}.json"
-    backup_path = f"{get_config('savepath')}{ctx.guild}{ctx.guild.id}.json"
+    path = get_save_path(ctx.guild)
+    backup_path = get_save_path(ctx.guild, backup=True)
 
     backup = get_data(ctx)
 
-    with open(path, "w") as data_file:
-        json.dump(data, data_file)
+    atomic_write(path, json.dumps(data))
+    atomic_write(backup_path, json.dumps(backup))
+
+    mark_changed(ctx.guild, data, backup)
+
+
+def atomic_write(path: str, content: str):
+    """
+    Write a file by replacing it with a temporary file, so readers never see a half written file
+    :param path: Path of the file
+    :param content: New content of the file
+    """
+    with open(f"{path}.tmp", "w") as tmp_file:
+        tmp_file.write(content)
+
+    os.replace(f"{path}.tmp", path)
+
+
+def mark_changed(guild, data: dict, previous: dict):
+    """
+    Update the cache and remember that the data of a guild has changed for the background workers
+    :param guild: Guild whose data has been written
+    :param data: New data of the guild
+    :param previous: Data of the guild before the change
+    """
+    with change_lock:
+        store_cache(guild.id, data)
+        changed_guilds[guild.id] = guild
+        known_guilds[guild.id] = guild
+
+        # Keep the state before the first change of this process, so it can be restored as well
+        if guild.id not in snapshot_seen:
+            snapshot_seen.add(guild.id)
+            initial_states[guild.id] = (guild, copy_data(previous), datetime.now())
+
+        change_counters[guild.id] = change_counters.get(guild.id, 0) + 1
+
+
+def get_snapshot_dir(guild_id: int) -> str:
+    """
+    Get the directory containing the snapshots of a guild
+    :param guild_id: Id of the guild
+    :return: Path of the snapshot directory
+    """
+    return os.path.join(get_config("snapshot_path"), str(guild_id))
+
+
+def get_blob_path(guild_id: int, digest: str) -> str:
+    """
+    Get the path of the compressed data with the given content hash. Snapshots are stored content-addressed, so
+    snapshots with the same content share one file
+    :param guild_id: Id of the guild
+    :param digest: Content hash of the data
+    :return: Path of the data file
+    """
+    return os.path.join(get_snapshot_dir(guild_id), "blobs", f"{digest}.json.gz")
+
+
+def list_snapshots(guild_id: int) -> list:
+    """
+    List the snapshots of a guild without reading them. Snapshots are empty files named TIMESTAMP-HASH.snap
+    referring to the data file with that content hash
+    :param guild_id: Id of the guild
+    :return: List of (datetime, content hash, path) tuples sorted from oldest to newest
+    """
+    directory = get_snapshot_dir(guild_id)
+    if not os.path.isdir(directory):
+        return []
+
+    snapshots = []
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(".snap"):
+            continue
+        try:
+            stamp, digest = file_name[:-len(".snap")].split("-")
+            snapshots.append((datetime.strptime(stamp, SNAPSHOT_TIME_FORMAT), digest,
+                              os.path.join(directory, file_name)))
+        except ValueError:
+            continue
+
+    snapshots.sort()
+    return snapshots
+
+
+def load_snapshot(path: str) -> dict:
+    """
+    Load the data stored in a single snapshot
+    :param path: Path of the snapshot file
+    :return: Stored data
+    """
+    with gzip.open(path, "rt") as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def take_snapshot(guild, data=None, stamp=None) -> bool:
+    """
+    Write a snapshot of the data of a guild, unless it equals the newest snapshot. The data is only compressed and
+    written if no other snapshot with the same content exists
+    :param guild: Guild to be saved
+    :param data: Data to be saved, the current save-file is used if not given
+    :param stamp: Time of the snapshot, defaults to now
+    :return: Whether a new snapshot has been written
+    """
+    if data is None:
+        with open(get_save_path(guild), "r") as data_file:
+            data = json.load(data_file)
+
+    content = json.dumps(data, sort_keys=True)
+
+    digest = hashlib.sha1(content.encode()).hexdigest()[:16]
+
+    # Skip the snapshot if nothing changed since the last one
+    snapshots = list_snapshots(guild.id)
+    if snapshots and snapshots[-1][1] == digest:
+        return False
+
+    blob_path = get_blob_path(guild.id, digest)
+    if not os.path.isfile(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        # Write to a temporary file first, so a snapshot is never half written
+        with gzip.open(f"{blob_path}.tmp", "wt") as snapshot_file:
+            snapshot_file.write(content)
+        os.replace(f"{blob_path}.tmp", blob_path)
+
+    stamp = stamp or datetime.now()
+    with open(os.path.join(get_snapshot_dir(guild.id), f"{stamp.strftime(SNAPSHOT_TIME_FORMAT)}-{digest}.snap"), "w"):
+        pass
+
+    return True
+
+
+def prune_snapshots(guild_id: int):
+    """
+    Apply the retention policy: keep all recent snapshots, of older ones only the newest of each of the last hours
+    and days
+    :param guild_id: Id of the guild
+    """
+    now = datetime.now()
+    keep_recent = get_config("snapshot_keep_recent")
+    keep_hourly = get_config("snapshot_keep_hourly")
+    keep_daily = get_config("snapshot_keep_daily")
+
+    kept = set()
+    hours = set()
+    days = set()
+    digests = set()
+    # Iterate from newest to oldest so the newest snapshot of every period is kept
+    for stamp, digest, path in reversed(list_snapshots(guild_id)):
+        hour = stamp.strftime("%Y%m%d%H")
+        day = stamp.strftime("%Y%m%d")
+
+        if (now - stamp).total_seconds() < keep_recent:
+            kept.add(path)
+        if hour not in hours and (now - stamp).total_seconds() < keep_hourly * 3600:
+            hours.add(hour)
+            kept.add(path)
+        if day not in days and (now - stamp).days < keep_daily:
+            days.add(day)
+            kept.add(path)
+
+        if path in kept:
+            digests.add(digest)
+        else:
+            os.remove(path)
+
+    # Remove the data no longer referred to by any snapshot
+    blob_dir = os.path.dirname(get_blob_path(guild_id, ""))
+    if os.path.isdir(blob_dir):
+        for file_name in os.listdir(blob_dir):
+            if file_name[:-len(".json.gz")] not in digests:
+                os.remove(os.path.join(blob_dir, file_name))
+
+
+def prune_all_snapshots():
+    """
+    Apply the retention policy to all guilds, including the ones which did not change for a long time
+    """
+    snapshot_path = get_config("snapshot_path")
+    if not os.path.isdir(snapshot_path):
+        return
+
+    for directory in os.listdir(snapshot_path):
+        if directory.isdigit():
+            try:
+                prune_snapshots(int(directory))
+            except Exception as e:
+                logging.error(e)
+
+
+def snapshot_changed():
+    """
+    Snapshot all guilds changed since the last run, preceded by their state before the first change
+    """
+    with change_lock:
+        initial = list(initial_states.values())
+        initial_states.clear()
+        guilds = list(changed_guilds.values())
+        changed_guilds.clear()
+
+    for guild, data, stamp in initial:
+        try:
+            if take_snapshot(guild, data, stamp):
+                logging.info(f"Saved initial snapshot of {guild}")
+        except Exception as e:
+            logging.error(e)
+            with change_lock:
+                initial_states.setdefault(guild.id, (guild, data, stamp))
+
+    for guild in guilds:
+        try:
+            if take_snapshot(guild):
+                logging.info(f"Saved snapshot of {guild}")
+            prune_snapshots(guild.id)
+        except Exception as e:
+            # Retry in the next run, e.g. if the save-file was read while being written
+            logging.error(e)
+            with change_lock:
+                changed_guilds.setdefault(guild.id, guild)
+
+
+def snapshot_loop(stop: threading.Event):
+    """
+    Background worker: periodically snapshot all guilds changed since the last run
+    :param stop: Event to end the worker, pending changes are saved before it ends
+    """
+    stopped = False
+    last_prune = None
+    while not stopped:
+        stopped = stop.wait(get_config("snapshot_interval"))
+        snapshot_changed()
+
+        # Changed guilds are pruned after each snapshot, all others on a slower timer
+        if last_prune is None or time.monotonic() - last_prune > get_config("snapshot_prune_interval"):
+            last_prune = time.monotonic()
+            prune_all_snapshots()
+
+
+def get_export_html(guild, data: dict) -> str:
+    """
+    Create a static HTML page listing all entries of a guild
+    :param guild: Guild the data belongs to
+    :param data: All entries of the guild
+    :return: HTML page
+    """
+    fields = [k for k in get_fields() if k not in ["Status", "Media", "Thumbnail"]]
+
+    rows = []
+    for name, entry in sorted(data.items()):
+        cells = [get_status(data, name), name] + [entry.get(k, "") for k in fields]
+        rows.append("<tr>" + "".join(f"<td>{html.escape(str(c))}</td>" for c in cells) + "</tr>")
+
+    header = "".join(f"<th>{html.escape(h)}</th>" for h in ["Status", "Name"] + fields)
+    title = html.escape(str(guild))
+
+    return (f"<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>{title}</title></head>\n<body>\n"
+            f"<h1>{title}</h1>\n<p>{len(data)} entries, exported {datetime.now().isoformat(timespec='seconds')}</p>\n"
+            f"<table>\n<tr>{header}</tr>\n" + "\n".join(rows) + "\n</table>\n</body>\n</html>\n")
+
+
+def get_content_hash(data: dict) -> str:
+    """
+    Helper function to get a hash of the data of a guild, which is independent of the order of the entries
+    :param data: All entries of a guild
+    :return: Content hash
+    """
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def export_guild(guild, data: dict, digest: str) -> dict:
+    """
+    Export the data of a guild as JSON and HTML file
+    :param guild: Guild to be exported
+    :param data: All entries of the guild
+    :param digest: Content hash of the data
+    :return: Entry of the guild in the export index
+    """
+    export_path = get_config("export_path")
+    summary = {
+        "id": guild.id,
+        "name": str(guild),
+        "hash": digest,
+        "exported": datetime.now().isoformat(timespec="seconds"),
+        "entries": len(data),
+        "json": f"{guild.id}.json",
+        "html": f"{guild.id}.html"
+    }
+
+    atomic_write(os.path.join(export_path, summary["json"]), json.dumps(dict(summary, data=data)))
+    atomic_write(os.path.join(export_path, summary["html"]), get_export_html(guild, data))
+
+    return summary
+
+
+def export_changed() -> int:
+    """
+    Export all guilds which changed since the last export and update the export index. Within a process the change
+    counters tell which guilds changed, the content hashes in the index cover changes from before a restart
+    :return: Amount of exported guilds
+    """
+    export_path = get_config("export_path")
+    os.makedirs(export_path, exist_ok=True)
 
-    with open(backup_path, "w") as data_file:
-        json.dump(backup, data_file)
+    index_path = os.path.join(export_path, "index.json")
+    if os.path.isfile(index_path):
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+    else:
+        index = dict()
+
+    # The guilds are collected on the event loop thread by on_ready and write_data
+    with change_lock:
+        guilds = list(known_guilds.values())
+
+    exported = 0
+    for guild in guilds:
+        # Read the counter before the data, a change while exporting is picked up by the next run
+        with change_lock:
+            version = change_counters.get(guild.id, 0)
+        if exported_counters.get(guild.id) == version:
+            continue
+
+        # Guilds which never used the bot have no save-file
+        if not os.path.isfile(get_save_path(guild)):
+            continue
+
+        try:
+            with open(get_save_path(guild), "r") as data_file:
+                data = json.load(data_file)
+
+            digest = get_content_hash(data)
+            if index.get(str(guild.id), dict()).get("hash") != digest:
+                index[str(guild.id)] = export_guild(guild, data, digest)
+                exported += 1
+
+            exported_counters[guild.id] = version
+        except Exception as e:
+            logging.error(e)
+
+    if exported:
+        atomic_write(index_path, json.dumps(index))
+
+    return exported
+
+
+def export_loop(stop: threading.Event):
+    """
+    Background worker: periodically export all guilds changed since the last run
+    :param stop: Event to end the worker
+    """
+    while not stop.wait(get_config("export_interval")):
+        try:
+            exported = export_changed()
+            if exported:
+                logging.info(f"Exported {exported} guilds")
+        except Exception as e:
+            logging.error(e)
+
+
+def install_index(guild, index: dict, version: int):
+    """
+    Install indexes built by the warm-up. Runs on the event loop thread, where commands update the indexes, so it
+    cannot interfere with a command changing an entry
+    :param guild: Guild the indexes belong to
+    :param index: The indexes
+    :param version: Change counter of the guild before the data was read
+    """
+    # Do not replace indexes which have been built or changed by a command in the meantime
+    if guild.id not in indexes and change_counters.get(guild.id, 0) == version:
+        indexes[guild.id] = index
+
+
+def warm_up_guild(guild, budget: dict) -> str:
+    """
+    Load the data and indexes of a single guild into memory, as long as the warm-up budget is not exceeded
+    :param guild: Guild to be loaded
+    :param budget: Shared budget containing the deadline and the estimated size of the data being loaded
+    :return: "loaded", "cached", "empty", "time" or "memory" describing the outcome
+    """
+    if time.perf_counter() > budget["deadline"]:
+        return "time"
+
+    # Guilds which never used the bot have no save-file, it should not be created for them
+    path = get_save_path(guild)
+    if not os.path.isfile(path):
+        return "empty"
+
+    # The warm-up must not evict guilds it loaded before, as they have been active more recently
+    estimate = os.path.getsize(path) * WARMUP_SIZE_FACTOR
+    with change_lock:
+        if guild.id in data_cache:
+            return "cached"
+        if cache_size + budget["pending"] + estimate > get_config("cache_memory_mb") * 1024 * 1024:
+            return "memory"
+        budget["pending"] += estimate
+        version = change_counters.get(guild.id, 0)
+
+    try:
+        data = load_guild_data(guild)
+    finally:
+        with change_lock:
+            budget["pending"] -= estimate
+
+    client.loop.call_soon_threadsafe(install_index, guild, build_index(data), version)
+
+    return "loaded"
+
+
+def warm_up(guilds: list):
+    """
+    Preload the data of the most recently active guilds in a thread pool, bounded by a time and memory budget
+    :param guilds: Guilds to be loaded
+    """
+    start = time.perf_counter()
+
+    # The last modification of the save-file tells when a guild has been active the last time
+    def last_active(guild):
+        path = get_save_path(guild)
+        return os.path.getmtime(path) if os.path.isfile(path) else 0
+
+    guilds = sorted(guilds, key=last_active, reverse=True)
+    budget = {
+        "deadline": start + get_config("warmup_seconds"),
+        "pending": 0
+    }
+
+    results = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_config("warmup_workers"),
+                                               thread_name_prefix="warmup") as pool:
+        for result in pool.map(lambda g: warm_up_guild(g, budget), guilds):
+            results[result] = results.get(result, 0) + 1
+
+    msg = (f"Warm-up finished in {time.perf_counter() - start:.2f}s, {time.perf_counter() - START_TIME:.2f}s after "
+           f"start: {results.get('loaded', 0)} guilds loaded (cache size {cache_size / 1024 / 1024:.1f} MB), "
+           f"{results.get('cached', 0)} already cached, {results.get('empty', 0)} without data, "
+           f"{results.get('time', 0)} skipped by the time budget, "
+           f"{results.get('memory', 0)} skipped by the memory budget")
+    logging.info(msg)
+    print(msg)
+
+
+def start_worker(name: str, target):
+    """
+    Start a background worker in a daemon thread, if it is not already running
+    :param name: Name of the worker
+    :param target: Function running the worker, it gets passed the event to stop it
+    """
+    if name in workers and workers[name].is_alive():
+        return
+
+    workers[name] = threading.Thread(target=target, args=(worker_stop,), name=name, daemon=True)
+    workers[name].start()
 
 
 def tuple_to_string(tup: tuple) -> str:
@@ -151,12 +733,119 @@ def set_status(ctx: Context, name: str, new_status: str) -> bool:
         return False
 
     # Set status and save to file
+    old_entry = dict(data[name])
     data[name]["Status"] = new_status
 
     write_data(data, ctx)
+    reindex_entry(ctx.guild, name, old_entry, data[name])
     return True
 
 
+def parse_tags(value: str) -> list:
+    """
+    Helper function to split a string into a sorted list of unique lowercase tags
+    :param value: Tags separated by commas or whitespaces
+    :return: List of tags
+    """
+    return sorted(set(value.replace(",", " ").lower().split()))
+
+
+def get_index_keys(entry: dict) -> dict:
+    """
+    Helper function to get the index keys of an entry
+    :param entry: Entry to be indexed
+    :return: Dict mapping the index name to the keys of the entry
+    """
+    return {
+        "tag": parse_tags(entry.get("Tags", "")),
+        "status": [entry.get("Status") or "none"]
+    }
+
+
+def index_entry(guild, name: str, entry: dict):
+    """
+    Add an entry to the secondary indexes of a guild. Nothing happens if the indexes have not been built yet
+    :param guild: Guild of the entry
+    :param name: Name of the entry
+    :param entry: The entry
+    """
+    if guild.id not in indexes:
+        return
+
+    for index, keys in get_index_keys(entry).items():
+        for key in keys:
+            indexes[guild.id][index].setdefault(key, set()).add(name)
+
+
+def unindex_entry(guild, name: str, entry: dict):
+    """
+    Remove an entry from the secondary indexes of a guild
+    :param guild: Guild of the entry
+    :param name: Name of the entry
+    :param entry: The entry as it has been indexed
+    """
+    if guild.id not in indexes:
+        return
+
+    for index, keys in get_index_keys(entry).items():
+        for key in keys:
+            names = indexes[guild.id][index].get(key)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del indexes[guild.id][index][key]
+
+
+def reindex_entry(guild, name: str, old_entry: dict, new_entry: dict):
+    """
+    Move a changed entry in the secondary indexes of a guild. Call it after the change has been written, so the
+    indexes are left untouched if writing fails
+    :param guild: Guild of the entry
+    :param name: Name of the entry
+    :param old_entry: The entry as it has been indexed
+    :param new_entry: The changed entry
+    """
+    unindex_entry(guild, name, old_entry)
+    index_entry(guild, name, new_entry)
+
+
+def build_index(data: dict) -> dict:
+    """
+    Build the secondary indexes of a guild from all of its entries
+    :param data: All entries of the guild
+    :return: The indexes
+    """
+    index = {"tag": dict(), "status": dict()}
+    for name, entry in data.items():
+        for index_name, keys in get_index_keys(entry).items():
+            for key in keys:
+                index[index_name].setdefault(key, set()).add(name)
+
+    return index
+
+
+def reindex(guild, data: dict):
+    """
+    Rebuild the secondary indexes of a guild from all of its entries
+    :param guild: Guild the data belongs to
+    :param data: All entries of the guild
+    """
+    indexes[guild.id] = build_index(data)
+
+
+def get_index(guild, data: dict) -> dict:
+    """
+    Get the secondary indexes of a guild, they get built on first use
+    :param guild: Guild the data belongs to
+    :param data: All entries of the guild
+    :return: Indexes of the guild
+    """
+    if guild.id not in indexes:
+        reindex(guild, data)
+
+    return indexes[guild.id]
+
+
 def get_closest(data: list, pattern: str, num=3) -> list:
     """
     Helper function to find the closest matches to the given pattern in data
@@ -202,13 +891,28 @@ async def on_ready():
     """
     Function will be executed once the bot is logged in
     """
-    logging.info("Successfully logged in.")
+    global warmup_started
+
+    logging.info(f"Successfully logged in after {time.perf_counter() - START_TIME:.2f}s.")
     print("Logged in!")
 
+    with change_lock:
+        for guild in client.guilds:
+            known_guilds[guild.id] = guild
+
+    start_worker("snapshot-worker", snapshot_loop)
+    start_worker("export-worker", export_loop)
+
     # Set status message to show the help command
     await client.change_presence(activity=discord.Activity(type=discord.ActivityType.listening,
                                                            name=f" {get_config('prefix')}help"))
 
+    # on_ready is executed again after reconnects, the warm-up is only needed once
+    if get_config("warmup") and not warmup_started:
+        warmup_started = True
+        # Commands are served by the event loop while the warm-up runs in other threads
+        await client.loop.run_in_executor(None, warm_up, list(client.guilds))
+
 
 @client.command(
     name="edit",
@@ -247,8 +951,14 @@ async def edit(ctx: Context, entry: str, field: str, *args: str):
 
         logging.info(f"Editing {entry}: {data[entry]}")
 
-        data[entry][field] = tuple_to_string(args)
+        value = tuple_to_string(args)
+        if field == "Tags":
+            value = join_list(parse_tags(value), ", ")
+
+        old_entry = dict(data[entry])
+        data[entry][field] = value
         write_data(data, ctx)
+        reindex_entry(ctx.guild, entry, old_entry, data[entry])
 
         logging.info(f"Successfully edited entry {entry}: {data[entry]}")
         await ctx.send(embed=discord.Embed(description=f"Successfully updated the entry: {entry}", color=0x00FF00))
@@ -314,6 +1024,8 @@ async def add(ctx: Context, name: str, *args: str):
         for k in fields.keys():
             # Check if the cmd is valid
             if cmd in fields[k]:
+                if k == "Tags":
+                    param = join_list(parse_tags(param), ", ")
                 new_entry[k] = param
                 logging.info(f"Set {k} field to: {param}")
                 break
@@ -337,6 +1049,7 @@ async def add(ctx: Context, name: str, *args: str):
         # Save entry to file
         data[name] = new_entry
         write_data(data, ctx)
+        index_entry(ctx.guild, name, new_entry)
 
         logging.info(f"Successfully saved new entry: {new_entry}")
         await ctx.send(embed=discord.Embed(description="New entry saved!", color=0x00FF00))
@@ -384,8 +1097,9 @@ async def delete(ctx: Context, name: str):
         logging.info(f"Deleting the entry: {data[name]}")
 
         # Delete the entry from the dict and save the dict to the file
-        del data[name]
+        entry = data.pop(name)
         write_data(data, ctx)
+        unindex_entry(ctx.guild, name, entry)
 
         await ctx.send(embed=discord.Embed(description=f"Successfully removed the entry: {name}", color=0x00FF00))
     except Exception as e:
@@ -464,7 +1178,8 @@ async def search(ctx: Context, name: str):
         for k in fields:
             # Filter out the default fields
             if k not in ["Thumbnail", "Location", "Direction", "Rates", "Instructions", "Info", "Media", "Status"]:
-                if data[name][k]:
+                # Entries created before a field was added do not contain it
+                if data[name].get(k):
                     msg.add_field(name=k, value=data[name][k], inline=False)
 
         if data[name]["Media"]:
@@ -508,28 +1223,143 @@ async def search_error(ctx: Context, error):
 @client.command(
     name="list",
     aliases=["all"],
-    description="List the names of all entries and their status",
+    description="List the names of all entries and their status. The list can be filtered using tag:TAG and "
+                "status:on|off|none, e.g. 'list tag:iron status:on'. Multiple filters must all match.",
     help="List the names of all entries"
 )
-async def list_all(ctx: Context):
+async def list_all(ctx: Context, *filters: str):
     """
     Command list: Creates a list of all entry names and displays it
     :param ctx: Context of the request
+    :param filters: Filters of the form INDEX:KEY, only entries matching all filters are listed
     """
     try:
         data = get_data(ctx)
 
-        # Create a list of all locations and their status, then concatenate the list to a single string
-        entry_list = [f"{get_status(data, i)}\t{i}" for i in data.keys()]
+        if not filters:
+            # Create a list of all locations and their status, then concatenate the list to a single string
+            entry_list = [f"{get_status(data, i)}\t{i}" for i in data.keys()]
+            entry_list = join_list(entry_list, "\n")
+
+            await ctx.send(embed=discord.Embed(title="All locations", color=BOT_COLOR, description=entry_list))
+            return
+
+        index = get_index(ctx.guild, data)
+
+        matches = []
+        for f in filters:
+            name, _, key = f.lower().partition(":")
+            if name not in index or not key:
+                await ctx.send(embed=discord.Embed(
+                    description=f"Invalid filter: {f}. Use tag:TAG or status:on|off|none", color=ERROR_COLOR))
+                return
+            matches.append(index[name].get(key, set()))
+
+        # Intersect starting with the smallest set
+        matches.sort(key=len)
+        result = set(matches[0]).intersection(*matches[1:])
+
+        entry_list = [f"{get_status(data, i)}\t{i}" for i in sorted(result)]
         entry_list = join_list(entry_list, "\n")
 
-        await ctx.send(embed=discord.Embed(title="All locations", color=BOT_COLOR, description=entry_list))
+        await ctx.send(embed=discord.Embed(title=f"Locations matching {tuple_to_string(filters)}", color=BOT_COLOR,
+                                           description=entry_list or "No matching entries"))
+
+    except Exception as e:
+        logging.error(e)
+        await send_error(ctx)
+
+
+async def change_tags(ctx: Context, name: str, tags: str, remove: bool):
+    """
+    Helper function to add or remove tags of an entry and reply accordingly
+    :param ctx: Context of the request
+    :param name: Name of the entry
+    :param tags: Tags to be added or removed
+    :param remove: Whether the tags should be removed instead of added
+    """
+    try:
+        data = get_data(ctx)
+
+        if name not in data:
+            await send_not_found(ctx, name)
+            return
+
+        current = set(parse_tags(data[name].get("Tags", "")))
+        changed = set(parse_tags(tags))
+        new_tags = current - changed if remove else current | changed
+
+        old_entry = dict(data[name])
+        data[name]["Tags"] = join_list(sorted(new_tags), ", ")
+        write_data(data, ctx)
+        reindex_entry(ctx.guild, name, old_entry, data[name])
+
+        logging.info(f"Set tags of {name} to: {data[name]['Tags']}")
+        await ctx.send(embed=discord.Embed(description=f"Successfully updated the tags of {name}", color=0x00FF00))
 
     except Exception as e:
         logging.error(e)
         await send_error(ctx)
 
 
+@client.command(
+    name="tag",
+    description="Add one or more tags to an entry. Tags can be used to filter the list command, e.g. 'list tag:iron'",
+    help="Add tags to an entry"
+)
+async def tag(ctx: Context, name: str, *, tags: str):
+    """
+    Command tag: Adds the given tags to an entry
+    :param ctx: Context of the request
+    :param name: Name of the entry
+    :param tags: Tags to be added
+    """
+    await change_tags(ctx, name, tags, remove=False)
+
+
+@tag.error
+async def tag_error(ctx: Context, error):
+    """
+    Error handling for function tag
+    :param ctx: Context of the request
+    :param error: Error type
+    """
+    if isinstance(error, errors.MissingRequiredArgument):
+        await ctx.send(embed=discord.Embed(
+            description=f"Missing argument! Usage: {get_config('prefix')}tag ENTRY_NAME TAG ...", color=ERROR_COLOR))
+    else:
+        await send_error(ctx)
+
+
+@client.command(
+    name="untag",
+    description="Remove one or more tags from an entry",
+    help="Remove tags from an entry"
+)
+async def untag(ctx: Context, name: str, *, tags: str):
+    """
+    Command untag: Removes the given tags from an entry
+    :param ctx: Context of the request
+    :param name: Name of the entry
+    :param tags: Tags to be removed
+    """
+    await change_tags(ctx, name, tags, remove=True)
+
+
+@untag.error
+async def untag_error(ctx: Context, error):
+    """
+    Error handling for function untag
+    :param ctx: Context of the request
+    :param error: Error type
+    """
+    if isinstance(error, errors.MissingRequiredArgument):
+        await ctx.send(embed=discord.Embed(
+            description=f"Missing argument! Usage: {get_config('prefix')}untag ENTRY_NAME TAG ...", color=ERROR_COLOR))
+    else:
+        await send_error(ctx)
+
+
 @client.command(
     name="media_add",
     aliases=["image_add", "add_media", "add_image", "add_link", "link_add"],
@@ -650,6 +1480,7 @@ async def undo(ctx: Context):
 
         # Write back the data
         write_data(backup_data, ctx)
+        reindex(ctx.guild, backup_data)
 
         # Implementation wor write data allows for redo by just executing undo twice
 
@@ -660,6 +1491,188 @@ async def undo(ctx: Context):
         await send_error(ctx)
 
 
+@client.command(
+    name="restore",
+    description="Restore all entries from the newest snapshot taken at or before the given time. The time can be "
+                "given as YYYY-MM-DD HH:MM:SS or as unix timestamp. The restore itself can be reverted using undo.",
+    help="Restore all entries from a snapshot"
+)
+@commands.has_permissions(administrator=True)
+async def restore(ctx: Context, *, timestamp: str):
+    """
+    Command restore: Replaces all entries with the ones of the newest snapshot at or before the given time
+    :param ctx: Context of the request
+    :param timestamp: Point in time to be restored
+    """
+    try:
+        if timestamp.isdigit():
+            target = datetime.fromtimestamp(int(timestamp))
+        else:
+            target = datetime.fromisoformat(timestamp)
+    except ValueError:
+        await ctx.send(embed=discord.Embed(description=f"Invalid timestamp: {timestamp}", color=ERROR_COLOR))
+        return
+
+    try:
+        snapshots = list_snapshots(ctx.guild.id)
+        if not snapshots:
+            await ctx.send(embed=discord.Embed(description="No snapshots available!", color=ERROR_COLOR))
+            return
+
+        # A later snapshot could already contain the change which should be reverted
+        earlier = [x for x in snapshots if x[0] <= target]
+        if not earlier:
+            await ctx.send(embed=discord.Embed(
+                description=f"No snapshot taken at or before {target}! The oldest one is from {snapshots[0][0]}.",
+                color=ERROR_COLOR))
+            return
+
+        # Only the chosen snapshot gets loaded
+        stamp, digest, _ = earlier[-1]
+        path = get_blob_path(ctx.guild.id, digest)
+        data = await client.loop.run_in_executor(None, load_snapshot, path)
+
+        logging.info(f"Restoring snapshot {path} from {stamp}")
+        write_data(data, ctx)
+        reindex(ctx.guild, data)
+
+        await ctx.send(embed=discord.Embed(
+            description=f"Successfully restored the snapshot from {stamp} (requested: {target})!", color=0x00FF00))
+
+    except Exception as e:
+        logging.error(e)
+        await send_error(ctx)
+
+
+@restore.error
+async def restore_error(ctx: Context, error):
+    """
+    Error handling for function restore
+    :param ctx: Context of the request
+    :param error: Error type
+    """
+    if isinstance(error, errors.MissingRequiredArgument):
+        await ctx.send(embed=discord.Embed(
+            description=f"Missing argument! Usage: {get_config('prefix')}restore TIMESTAMP", color=ERROR_COLOR))
+    elif isinstance(error, errors.MissingPermissions):
+        await ctx.send(embed=discord.Embed(
+            description="Only administrators are allowed to restore snapshots!", color=ERROR_COLOR))
+    else:
+        await send_error(ctx)
+
+
+def build_profile_report(profiler: cProfile.Profile, start: tracemalloc.Snapshot, end: tracemalloc.Snapshot,
+                         seconds: int, num=30) -> str:
+    """
+    Helper function to format the results of the profile command
+    :param profiler: Profiler which has been capturing the event loop
+    :param start: Memory snapshot taken at the start
+    :param end: Memory snapshot taken at the end
+    :param seconds: Duration of the capture
+    :param num: Amount of functions and allocation sites listed
+    :return: Report as text
+    """
+    report = io.StringIO()
+    report.write(f"Profile of the event loop thread over {seconds} seconds\n\n")
+
+    stats = pstats.Stats(profiler, stream=report)
+    stats.strip_dirs()
+    report.write("=== Top functions by own time ===\n")
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(num)
+    report.write("=== Top functions by cumulative time ===\n")
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(num)
+
+    # Ignore the allocations of tracemalloc itself
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = end.filter_traces(ignore).compare_to(start.filter_traces(ignore), "lineno")
+    report.write("=== Top allocation sites by growth ===\n")
+    for d in diff[:num]:
+        report.write(f"{d}\n")
+
+    report.write("\n=== Top allocation sites by size ===\n")
+    for stat in end.filter_traces(ignore).statistics("lineno")[:num]:
+        report.write(f"{stat}\n")
+
+    return report.getvalue()
+
+
+@client.command(
+    name="profile",
+    description="Capture a cProfile and tracemalloc profile of the bot for the given amount of seconds and send the "
+                "hottest functions and allocation sites as attachment. Only the owner of the bot can use this command.",
+    help="Profile the bot for some seconds"
+)
+@commands.is_owner()
+async def profile(ctx: Context, seconds: int):
+    """
+    Command profile: Profiles the event loop and memory allocations for a bounded time
+    :param ctx: Context of the request
+    :param seconds: Duration of the capture
+    """
+    global profiling
+
+    if profiling:
+        await ctx.send(embed=discord.Embed(description="A profile is already being captured!", color=ERROR_COLOR))
+        return
+
+    seconds = min(max(seconds, 1), get_config("profile_max_seconds"))
+    profiling = True
+    profiler = cProfile.Profile()
+    # Do not stop tracemalloc if it has been started by someone else
+    stop_tracing = not tracemalloc.is_tracing()
+
+    try:
+        if stop_tracing:
+            tracemalloc.start()
+        start = tracemalloc.take_snapshot()
+
+        await ctx.send(embed=discord.Embed(description=f"Profiling for {seconds} seconds...", color=BOT_COLOR))
+
+        # All commands run on the event loop thread, so they are captured while this command sleeps
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+
+        end = tracemalloc.take_snapshot()
+
+        report = await client.loop.run_in_executor(None, build_profile_report, profiler, start, end, seconds)
+        logging.info(f"Captured a profile over {seconds} seconds")
+
+        await ctx.send(embed=discord.Embed(description="Profiling finished!", color=0x00FF00),
+                       file=discord.File(io.BytesIO(report.encode()), filename="profile.txt"))
+
+    except Exception as e:
+        logging.error(e)
+        await send_error(ctx)
+
+    finally:
+        if stop_tracing:
+            tracemalloc.stop()
+        profiling = False
+
+
+@profile.error
+async def profile_error(ctx: Context, error):
+    """
+    Error handling for function profile
+    :param ctx: Context of the request
+    :param error: Error type
+    """
+    if isinstance(error, errors.MissingRequiredArgument):
+        await ctx.send(embed=discord.Embed(
+            description=f"Missing argument! Usage: {get_config('prefix')}profile SECONDS", color=ERROR_COLOR))
+    elif isinstance(error, errors.BadArgument):
+        await ctx.send(embed=discord.Embed(
+            description="Invalid argument! SECONDS must be a whole number.", color=ERROR_COLOR))
+    elif isinstance(error, errors.NotOwner):
+        await ctx.send(embed=discord.Embed(
+            description="Only the owner of the bot is allowed to profile it!", color=ERROR_COLOR))
+    else:
+        await send_error(ctx)
+
+
 @client.command(
     name="on",
     aliases=["activate", "active"],
@@ -775,4 +1788,13 @@ async def del_status_error(ctx: Context, error):
         await send_error(ctx)
 
 
-client.run(token)
+if __name__ == "__main__":
+    with open(get_config("token_file"), "r") as file:
+        token = file.read()
+
+    client.run(token)
+
+    # Let the workers finish, e.g. to save the last snapshots
+    worker_stop.set()
+    for worker in workers.values():
+        worker.join()
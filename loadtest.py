@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Weights of the simulated commands
+COMMAND_MIX = {
+    "add": 25,
+    "edit": 12,
+    "on": 7,
+    "off": 6,
+    "tag": 8,
+    "untag": 4,
+    "info": 15,
+    "list": 8,
+    "list_filtered": 8,
+    "delete": 5,
+    "undo": 2,
+}
+
+# Commands which write the data of the guild when they succeed
+WRITING_COMMANDS = ["add", "edit", "on", "off", "tag", "untag", "delete", "undo"]
+
+TAGS = ["iron", "gold", "farm", "copper", "mob"]
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Parse the command line arguments of the load generator
+    :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Offline load generator for the information bot. Synthetic messages "
+                                                 "are passed to the on_message handler of the bot, replies are "
+                                                 "captured by a stubbed ctx.send.")
+    parser.add_argument("--rate", type=float, default=200, help="Messages per second")
+    parser.add_argument("--duration", type=float, default=10, help="Duration of the run in seconds")
+    parser.add_argument("--guilds", type=int, default=20, help="Number of simulated guilds")
+    parser.add_argument("--channels", type=int, default=5, help="Number of simulated channels per guild")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random workload")
+    parser.add_argument("--lag-interval", type=float, default=0.01, help="Interval of the event-loop lag probe")
+    parser.add_argument("--snapshot-interval", type=float, default=0,
+                        help="Run the snapshot worker with this interval in seconds (0 disables it)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directory")
+    return parser.parse_args()
+
+
+def setup_workdir(args: argparse.Namespace) -> str:
+    """
+    Create a temporary working directory containing a config pointing all files into it
+    :param args: Command line arguments
+    :return: Path of the working directory
+    """
+    workdir = tempfile.mkdtemp(prefix="infobot-load-")
+
+    with open(os.path.join(REPO_DIR, "config.json"), "r") as config_file:
+        config = json.load(config_file)
+
+    config["logfile"] = os.path.join(workdir, "load.log")
+    config["savepath"] = os.path.join(workdir, "data", "")
+    config["snapshot_path"] = os.path.join(workdir, "data", "snapshots", "")
+    if args.snapshot_interval:
+        config["snapshot_interval"] = args.snapshot_interval
+
+    with open(os.path.join(workdir, "config.json"), "w") as config_file:
+        json.dump(config, config_file)
+
+    shutil.copy(os.path.join(REPO_DIR, "input_fields.json"), workdir)
+    os.makedirs(config["savepath"])
+
+    return workdir
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Helper function to get a percentile of a list of values
+    :param values: Sorted list of values
+    :param p: Percentile between 0 and 100
+    :return: Value at the percentile
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    args = parse_args()
+    workdir = setup_workdir(args)
+
+    # The bot reads its config from the working directory at import time
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    import discord
+    import infobot
+
+    from discord.ext.commands.context import Context
+
+    class FakeGuild:
+        def __init__(self, number: int):
+            # Snowflake sized ids, the backup file name is the guild name followed by its id
+            self.id = 10 ** 17 + number
+            self.name = f"loadguild{number}"
+
+        def __str__(self):
+            return self.name
+
+    class FakeChannel:
+        def __init__(self, guild: FakeGuild, channel_id: int):
+            self.id = channel_id
+            self.guild = guild
+
+        def permissions_for(self, member):
+            return discord.Permissions.all()
+
+    class FakeUser:
+        def __init__(self, user_id: int):
+            self.id = user_id
+            self.bot = user_id == 0
+
+    class FakeMessage:
+        def __init__(self, message_id: int, cmd: str, content: str, channel: FakeChannel):
+            self.id = message_id
+            self.content = content
+            self.channel = channel
+            self.guild = channel.guild
+            self.author = FakeUser(1)
+            self._state = None
+            # Information for the load generator
+            self.cmd = cmd
+            self.replies = []
+
+    async def send(ctx: Context, content=None, **kwargs):
+        """
+        Stub of ctx.send: records the reply and applies successful writes to the expected state
+        """
+        embed = kwargs.get("embed")
+        ctx.message.replies.append(embed)
+
+        # Commands reply right after writing, so the order of the replies is the order of the writes
+        if embed is not None and embed.color.value != infobot.ERROR_COLOR and ctx.message.cmd in WRITING_COMMANDS:
+            apply_write(ctx.message)
+
+    Context.send = send
+    # The bot is never logged in, messages must not look like they are sent by itself
+    infobot.client._connection.user = FakeUser(0)
+
+    guilds = [FakeGuild(i) for i in range(args.guilds)]
+    channels = {g.id: [FakeChannel(g, g.id * 100 + i) for i in range(args.channels)] for g in guilds}
+    prefix = infobot.get_config("prefix")
+    rng = random.Random(args.seed)
+
+    # Expected entry names and the names of the previous save (restored by undo) per guild
+    expected = {g.id: set() for g in guilds}
+    expected_backup = {g.id: set() for g in guilds}
+    latencies = {cmd: [] for cmd in COMMAND_MIX}
+    lags = []
+    stats = {"sent": 0, "errors": 0, "exceptions": 0}
+    # Counters of the entry names and message ids
+    counter = [0, 0]
+
+    def apply_write(message: FakeMessage):
+        """
+        Apply a successful write to the expected state of the guild
+        """
+        guild_id = message.guild.id
+        if message.cmd == "undo":
+            expected[guild_id], expected_backup[guild_id] = expected_backup[guild_id], expected[guild_id]
+            return
+
+        expected_backup[guild_id] = set(expected[guild_id])
+        name = message.content.split(" ")[1]
+        if message.cmd == "add":
+            expected[guild_id].add(name)
+        elif message.cmd == "delete":
+            expected[guild_id].discard(name)
+
+    def make_command(guild: FakeGuild):
+        """
+        Choose a random command for the guild
+        :return: Tuple of command name and message content, or None if the command is not possible
+        """
+        cmd = rng.choices(list(COMMAND_MIX), weights=list(COMMAND_MIX.values()))[0]
+        names = expected[guild.id]
+
+        if cmd == "add":
+            counter[0] += 1
+            return cmd, f"{prefix}add entry{counter[0]} location={rng.randint(-1000, 1000)} $ tag={rng.choice(TAGS)}"
+        if cmd == "list":
+            return cmd, f"{prefix}list"
+        if cmd == "list_filtered":
+            return cmd, f"{prefix}list tag:{rng.choice(TAGS)} status:{rng.choice(['on', 'off', 'none'])}"
+        if cmd == "undo":
+            return cmd, f"{prefix}undo"
+        if not names:
+            return None
+
+        # Names of deleted entries may still be chosen by messages already in flight
+        name = rng.choice(sorted(names))
+        if cmd == "edit":
+            return cmd, f"{prefix}edit {name} info edited {rng.random()}"
+        if cmd in ["tag", "untag"]:
+            return cmd, f"{prefix}{cmd} {name} {infobot.tuple_to_string(rng.sample(TAGS, 2))}"
+        return cmd, f"{prefix}{cmd} {name}"
+
+    async def dispatch(cmd: str, content: str, channel: FakeChannel, scheduled: float):
+        """
+        Pass a single message to the on_message handler of the bot, like the gateway would
+        """
+        counter[1] += 1
+        message = FakeMessage(counter[1], cmd, content, channel)
+
+        try:
+            await infobot.client.on_message(message)
+        except Exception as e:
+            stats["exceptions"] += 1
+            print(f"Exception in {content}: {e}", file=sys.stderr)
+
+        latencies[cmd].append(time.perf_counter() - scheduled)
+
+        failed = any(r is not None and r.color.value == infobot.ERROR_COLOR for r in message.replies)
+        if failed or not message.replies:
+            stats["errors"] += 1
+
+    async def lag_probe(stop: asyncio.Event):
+        """
+        Measure how late the event loop wakes up a sleeping task
+        """
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(args.lag_interval)
+            lags.append(time.perf_counter() - start - args.lag_interval)
+
+    async def run():
+        stop = asyncio.Event()
+        probe = asyncio.ensure_future(lag_probe(stop))
+        tasks = []
+
+        total = int(args.rate * args.duration)
+        start = time.perf_counter()
+        for i in range(total):
+            # Open loop: messages arrive on schedule, even if the bot falls behind
+            scheduled = start + i / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            guild = rng.choice(guilds)
+            command = make_command(guild)
+            if command is None:
+                continue
+
+            stats["sent"] += 1
+            tasks.append(asyncio.ensure_future(dispatch(*command, rng.choice(channels[guild.id]), scheduled)))
+
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        await probe
+        return elapsed
+
+    if args.snapshot_interval:
+        infobot.start_worker("snapshot-worker", infobot.snapshot_loop)
+
+    elapsed = infobot.client.loop.run_until_complete(run())
+
+    if args.snapshot_interval:
+        infobot.worker_stop.set()
+        infobot.workers["snapshot-worker"].join()
+
+    # Data integrity: the save-files must match the expected entries and the indexes must match the save-files
+    missing = 0
+    unexpected = 0
+    stale_indexes = 0
+    corrupt = 0
+    for guild in guilds:
+        # Read the save-file itself, get_data is served from the cache
+        if not os.path.isfile(infobot.get_save_path(guild)):
+            continue
+        try:
+            with open(infobot.get_save_path(guild), "r") as data_file:
+                data = json.load(data_file)
+        except ValueError:
+            corrupt += 1
+            continue
+        missing += len(expected[guild.id] - set(data))
+        unexpected += len(set(data) - expected[guild.id])
+        if guild.id in infobot.indexes and infobot.indexes[guild.id] != infobot.build_index(data):
+            stale_indexes += 1
+
+    all_latencies = sorted(x for v in latencies.values() for x in v)
+    lags.sort()
+
+    print(f"Working directory: {workdir}")
+    print(f"Messages: {stats['sent']} in {elapsed:.2f}s ({stats['sent'] / elapsed:.1f}/s), "
+          f"error replies: {stats['errors']}, exceptions: {stats['exceptions']}")
+    print(f"{'command':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for cmd, values in sorted(latencies.items()) + [("all", all_latencies)]:
+        values = sorted(values)
+        if not values:
+            continue
+        print(f"{cmd:<14}{len(values):>8}" +
+              "".join(f"{percentile(values, p) * 1000:>10.2f}" for p in (50, 95, 99, 100)))
+    print(f"Event-loop lag: p50 {percentile(lags, 50) * 1000:.2f}ms, p99 {percentile(lags, 99) * 1000:.2f}ms, "
+          f"max {percentile(lags, 100) * 1000:.2f}ms")
+    print(f"Integrity: {missing} missing entries, {unexpected} unexpected entries, {stale_indexes} stale indexes, "
+          f"{corrupt} corrupt save-files")
+
+    if not args.keep:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir)
+
+    if missing or unexpected or stale_indexes or corrupt:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()